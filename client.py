@@ -0,0 +1,37 @@
+import sys
+import os
+import socket
+import json
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit('usage: client.py SOCKET [main.py arguments...]')
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sys.argv[1])
+        sock.sendall(json.dumps({'cwd': os.getcwd(), 'argv': sys.argv[2:]}))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    
+    response = json.loads(''.join(chunks))
+    
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    
+    if response['launch']:
+        import subprocess
+        for output_path in response['launch']:
+            subprocess.Popen(['openscad', output_path])
+    
+    sys.exit(response['exit_code'])
+    
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,15 @@ import os
 import argparse
 import imp
 import subprocess
+import socket
+import json
+import hashlib
+import traceback
+import signal
+import StringIO
+import stat
+import errno
+import SocketServer
 
 import scadgen
 
@@ -12,32 +21,220 @@ def launch_openscad(output_path):
     
     subprocess.Popen(['openscad', output_path])
 
-def main():
+def build_model(script, script_path, output_formats, quality, cost_budget, cost_report):
+    model = script.model()
+    
+    if isinstance(model, dict):
+        parts = model
+    else:
+        parts = {os.path.splitext(os.path.basename(script_path))[0]: model}
+    
+    report = None
+    if cost_report is not None:
+        estimates = [est for name in sorted(parts) for est in scadgen.estimate_cost(parts[name], quality, name)]
+        report = scadgen.format_cost_report(estimates, cost_report)
+    
+    outputs = scadgen.build_outputs(parts, output_formats, quality, cost_budget)
+    
+    return ([(name, fmt, outputs[(name, fmt)]) for (name, fmt) in sorted(outputs)], report)
+
+class ScriptCache(object):
+    def __init__(self):
+        self._entries = {}
+        self._tracking = None
+    
+    def load(self, path):
+        path = os.path.abspath(path)
+        entry = self._entries.get(path)
+        if entry is None or any(_source_mtime(dep_path) != mtime for (dep_path, mtime) in entry[0]):
+            self._forget_user_modules()
+            mtime = _source_mtime(path)
+            module_name = 'the_script_{}'.format(hashlib.sha1(path).hexdigest())
+            loaded_before = set(sys.modules)
+            module = imp.load_source(module_name, path)
+            entry = ([(path, mtime)], module, [])
+            self._entries[path] = entry
+            self._tracking = (entry, module_name, loaded_before)
+        return entry[1]
+    
+    def record_imports(self):
+        if self._tracking is None:
+            return
+        ((mtimes, module, dep_names), module_name, loaded_before) = self._tracking
+        self._tracking = None
+        for name in set(sys.modules) - loaded_before:
+            if name != module_name and _is_user_module(sys.modules[name]):
+                dep_path = _source_path(sys.modules[name].__file__)
+                dep_names.append(name)
+                mtimes.append((dep_path, _source_mtime(dep_path)))
+    
+    def _forget_user_modules(self):
+        for (mtimes, module, dep_names) in self._entries.values():
+            for name in dep_names:
+                sys.modules.pop(name, None)
+
+_SYSTEM_PREFIXES = tuple(os.path.abspath(prefix) + os.sep for prefix in set((sys.prefix, sys.exec_prefix, getattr(sys, 'real_prefix', sys.prefix))))
+
+def _is_user_module(module):
+    module_file = getattr(module, '__file__', None)
+    if module_file is None:
+        return False
+    return not os.path.abspath(module_file).startswith(_SYSTEM_PREFIXES)
+
+def _source_path(module_file):
+    (base, ext) = os.path.splitext(module_file)
+    if ext in ('.pyc', '.pyo') and os.path.exists(base + '.py'):
+        return base + '.py'
+    return module_file
+
+def _source_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read()
+        if not data:
+            return
+        request = json.loads(data)
+        launch_paths = []
+        (saved_stdout, saved_stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        try:
+            try:
+                os.chdir(request['cwd'])
+                argv = [arg.encode('utf-8') for arg in request['argv']]
+                try:
+                    run(argv, self.server.script_cache.load, launch_paths.append)
+                finally:
+                    self.server.script_cache.record_imports()
+                exit_code = 0
+            except SystemExit as e:
+                exit_code = _exit_code(e.code)
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+                exit_code = 1
+            response = {'stdout': sys.stdout.getvalue(), 'stderr': sys.stderr.getvalue(), 'exit_code': exit_code, 'launch': launch_paths}
+        finally:
+            (sys.stdout, sys.stderr) = (saved_stdout, saved_stderr)
+        self.wfile.write(json.dumps(response))
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if type(code) is int:
+        return code
+    sys.stderr.write('{}\n'.format(code))
+    return 1
+
+class BuildServer(SocketServer.UnixStreamServer):
+    def __init__(self, socket_path):
+        _remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, BuildRequestHandler)
+        self.script_cache = ScriptCache()
+
+def _remove_stale_socket(socket_path):
+    try:
+        mode = os.stat(socket_path).st_mode
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise ValueError('{} exists and is not a socket.'.format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise ValueError('A build server is already listening on {}.'.format(socket_path))
+
+def serve(socket_path):
+    try:
+        server = BuildServer(socket_path)
+    except ValueError as e:
+        sys.exit(str(e))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+def run(argv, load_script, launch, serve=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('input_script', help='Input Python script with model.')
-    parser.add_argument('-f', '--output-format', default='openscad', help='Output format.')
+    parser.add_argument('input_script', nargs='?', help='Input Python script with model.')
+    parser.add_argument('-f', '--output-format', default='openscad', help='Output format, or a comma-separated list of formats.')
     parser.add_argument('-o', '--output-file', type=argparse.FileType('w'), help='Write OpenSCAD output to this file.')
+    parser.add_argument('-d', '--output-dir', help='Write one file per part and format to this directory.')
+    parser.add_argument('-q', '--quality', default='default', choices=sorted(scadgen.QUALITIES), help='Tessellation quality. "default" uses fn=32 wherever fn is not given; "final" and "preview" derive it from the radius.')
+    parser.add_argument('--cost-budget', type=float, help='Fail if the estimated render cost exceeds this value.')
+    parser.add_argument('--cost-report', type=int, metavar='N', help='Print the N most expensive subtrees to stderr.')
     parser.add_argument('-s', '--openscad', action='store_true', help='Open output in OpenSCAD GUI.')
-    args = parser.parse_args()
+    parser.add_argument('--serve', metavar='SOCKET', help='Run as a build server listening on this Unix socket; use client.py to forward builds to it. Model scripts are reloaded when they or the non-standard-library modules they import change.')
+    args = parser.parse_args(argv)
     
-    script = imp.load_source('the_script', args.input_script)
+    if args.serve is not None:
+        if serve is None:
+            parser.error('--serve cannot be forwarded to a build server.')
+        serve(args.serve)
+        return
     
-    model = script.model()
+    if args.input_script is None:
+        parser.error('input_script is required unless --serve is given.')
+    
+    if args.output_file is not None and args.output_dir is not None:
+        parser.error('--output-file and --output-dir cannot be used together.')
+    
+    output_formats = args.output_format.split(',')
     
-    scad_src = scadgen.build_output(model, args.output_format)
+    script = load_script(args.input_script)
+    (outputs, report) = build_model(script, args.input_script, output_formats, args.quality, args.cost_budget, args.cost_report)
     
-    output_path = None
+    if report is not None:
+        sys.stderr.write(report)
     
-    if args.output_file is not None:
-        output = args.output_file
-        output_path = os.path.abspath(output.name)
-        output.write(scad_src)
-        output.close()
+    output_paths = []
+    
+    if args.output_dir is not None:
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        for (name, fmt, src) in outputs:
+            output_path = os.path.abspath(os.path.join(args.output_dir, '{}.{}'.format(name, scadgen.FORMAT_EXTENSIONS[fmt])))
+            with open(output_path, 'w') as output:
+                output.write(src)
+            if fmt == 'openscad':
+                output_paths.append(output_path)
     else:
-        sys.stdout.write(scad_src)
+        if len(outputs) != 1:
+            sys.exit('Multiple parts or formats require --output-dir.')
+        (name, fmt, src) = outputs[0]
+        if args.output_file is not None:
+            output = args.output_file
+            output_paths.append(os.path.abspath(output.name))
+            output.write(src)
+            output.close()
+        else:
+            sys.stdout.write(src)
     
     if args.openscad:
-        launch_openscad(output_path)
+        if not output_paths:
+            launch_openscad(None)
+        for output_path in output_paths:
+            launch(output_path)
+
+def main():
+    run(sys.argv[1:], lambda path: imp.load_source('the_script', path), launch_openscad, serve)
     
 if __name__ == '__main__':
     main()
@@ -1,2 +1,3 @@
 from scad import *
 from spacemath import *
+from serialize import *
@@ -1,5 +1,7 @@
 import itertools
+import heapq
 import math
+import os
 from spacemath import *
 
 
@@ -7,7 +9,9 @@ class Object(object):
     pass
 
 class PrimitiveObject(Object):
-    pass
+    def _render_cost(self, resolution, child_costs):
+        facets = self._facet_count(resolution)
+        return RenderCost(facets, float(facets))
 
 class ComposedObject(Object):
     def __init__(self, children):
@@ -30,11 +34,24 @@ class ComposedObject(Object):
         else:
             return Mat4.ID
     
-    def _openscad_child_ops(self):
-        return [child._openscad_operation() for child in self._children]
+    def _openscad_child_ops(self, lowering):
+        return [lowering.openscad_operation(child) for child in self._children]
+    
+    def _openjscad_child_ops(self, lowering):
+        return [lowering.openjscad_operation(child) for child in self._children]
     
-    def _openjscad_child_ops(self):
-        return [child._openjscad_operation() for child in self._children]
+    def _boolean_render_cost(self, child_costs):
+        if not child_costs:
+            return RenderCost(0, 0.0)
+        facets = child_costs[0].facets
+        cost = sum(child_cost.cost for child_cost in child_costs)
+        for child_cost in child_costs[1:]:
+            facets += child_cost.facets
+            cost += facets
+        return RenderCost(facets, cost)
+    
+    def _transform_render_cost(self, child_costs):
+        return RenderCost(child_costs[0].facets, child_costs[0].cost)
 
 class ChildProxy(object):
     def __init__(self, parent, index, context):
@@ -141,26 +158,29 @@ class Cube(PrimitiveObject):
     def _dim_max(self, dim):
         return self._size[dim]/2 if self._centered[dim] else self._size[dim]
     
-    def _openscad_operation(self):
+    def _facet_count(self, resolution):
+        return 6
+    
+    def _openscad_operation(self, lowering):
         op = OpenscadOperation('cube', [self._size], {})
         if self._has_offset:
             op = OpenscadOperation('translate', [self._offset], {}, [op])
         return op
     
-    def _openjscad_operation(self):
+    def _openjscad_operation(self, lowering):
         op = OpenjsscadOperation('cube', kw_args={'size':self._size})
         if self._has_offset:
             op = OpenjsscadOperation('translate', pos_args=[self._offset], inputs=[op], is_method=True)
         return op
 
 class Cylinder(PrimitiveObject):
-    def __init__(self, h, r=None, r1=None, r2=None, center=False, fn=32, internal=False, flat_base=False):
+    def __init__(self, h, r=None, r1=None, r2=None, center=False, fn=None, internal=False, flat_base=False):
         h = _float_arg(h)
         r = _float_arg(r, allow_none=True)
         r1 = _float_arg(r1, allow_none=True)
         r2 = _float_arg(r2, allow_none=True)
         center = _bool_arg(center)
-        fn = _int_arg(fn)
+        fn = _int_arg(fn, allow_none=True)
         internal = _bool_arg(internal)
         flat_base = _bool_arg(flat_base)
         
@@ -171,16 +191,12 @@ class Cylinder(PrimitiveObject):
         else:
             assert r1 is not None and r2 is not None, "If either 'r1' or 'r2' is given then both must be."
         
-        if internal:
-            ratio = math.cos(math.pi / fn)
-            r1 /= ratio
-            r2 /= ratio
-        
         self._h = h
         self._r1 = r1
         self._r2 = r2
         self._center = center
         self._fn = fn
+        self._internal = internal
         self._flat_base = flat_base
     
     def center(self):
@@ -192,22 +208,38 @@ class Cylinder(PrimitiveObject):
     def top_center(self):
         return Vec3(0.0, 0.0, self._h/2 if self._center else self._h)
     
-    def _openscad_operation(self):
-        op = OpenscadOperation('cylinder', [], {'h':self._h, 'r1':self._r1, 'r2':self._r2, 'center':self._center, '$fn':self._fn})
+    def _get_fn(self, resolution):
+        return _resolve_fn(self._fn, max(self._r1, self._r2), resolution)
+    
+    def _get_radii(self, fn):
+        if not self._internal:
+            return (self._r1, self._r2)
+        ratio = math.cos(math.pi / fn)
+        return (self._r1 / ratio, self._r2 / ratio)
+    
+    def _facet_count(self, resolution):
+        return self._get_fn(resolution) + 2
+    
+    def _openscad_operation(self, lowering):
+        fn = self._get_fn(lowering.resolution)
+        (r1, r2) = self._get_radii(fn)
+        op = OpenscadOperation('cylinder', [], {'h':self._h, 'r1':r1, 'r2':r2, 'center':self._center, '$fn':fn})
         if self._flat_base:
-            op = OpenscadOperation('rotate', [180.0 / self._fn], {}, [op])
+            op = OpenscadOperation('rotate', [180.0 / fn], {}, [op])
         return op
     
-    def _openjscad_operation(self):
-        op = OpenjsscadOperation('cylinder', kw_args={'h':self._h, 'r1':self._r1, 'r2':self._r2, 'center':self._center, 'fn':self._fn})
+    def _openjscad_operation(self, lowering):
+        fn = self._get_fn(lowering.resolution)
+        (r1, r2) = self._get_radii(fn)
+        op = OpenjsscadOperation('cylinder', kw_args={'h':self._h, 'r1':r1, 'r2':r2, 'center':self._center, 'fn':fn})
         if self._flat_base:
-            op = OpenjsscadOperation('rotateZ', pos_args=[180.0 / self._fn], inputs=[op], is_method=True)
+            op = OpenjsscadOperation('rotateZ', pos_args=[180.0 / fn], inputs=[op], is_method=True)
         return op
 
 class Sphere(PrimitiveObject):
-    def __init__(self, r, fn=32):
+    def __init__(self, r, fn=None):
         r = _float_arg(r)
-        fn = _int_arg(fn)
+        fn = _int_arg(fn, allow_none=True)
         
         self._r = r
         self._fn = fn
@@ -215,11 +247,18 @@ class Sphere(PrimitiveObject):
     def center(self):
         return Vec3(0.0, 0.0, 0.0)
     
-    def _openscad_operation(self):
-        return OpenscadOperation('sphere', [], {'r':self._r, '$fn':self._fn})
+    def _get_fn(self, resolution):
+        return _resolve_fn(self._fn, self._r, resolution)
+    
+    def _facet_count(self, resolution):
+        fn = self._get_fn(resolution)
+        return fn * ((fn + 1) // 2)
     
-    def _openjscad_operation(self):
-        return OpenjsscadOperation('sphere', kw_args={'r':self._r, 'fn':self._fn})
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('sphere', [], {'r':self._r, '$fn':self._get_fn(lowering.resolution)})
+    
+    def _openjscad_operation(self, lowering):
+        return OpenjsscadOperation('sphere', kw_args={'r':self._r, 'fn':self._get_fn(lowering.resolution)})
 
 class OpenscadModule(PrimitiveObject):
     def __init__(self, mod_name, args, kwargs, imports):
@@ -228,45 +267,60 @@ class OpenscadModule(PrimitiveObject):
         self._kwargs = kwargs
         self._imports = imports
     
-    def _openscad_operation(self):
+    def _facet_count(self, resolution):
+        return _UNKNOWN_FACET_COUNT
+    
+    def _openscad_operation(self, lowering):
         return OpenscadOperation(self._mod_name, self._args, self._kwargs, imports=self._imports)
 
 class Import(PrimitiveObject):
     def __init__(self, src_file):
         self._src_file = src_file
     
-    def _openscad_operation(self):
+    def _facet_count(self, resolution):
+        return _UNKNOWN_FACET_COUNT
+    
+    def _openscad_operation(self, lowering):
         return OpenscadOperation('import', [self._src_file], {})
 
 class Union(ComposedObject):
     def __init__(self, children):
         ComposedObject.__init__(self, children)
     
-    def _openscad_operation(self):
-        return OpenscadOperation('union', [], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        return self._boolean_render_cost(child_costs)
+    
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('union', [], {}, self._openscad_child_ops(lowering))
     
-    def _openjscad_operation(self):
-        return OpenjsscadOperation('union', inputs=self._openjscad_child_ops())
+    def _openjscad_operation(self, lowering):
+        return OpenjsscadOperation('union', inputs=self._openjscad_child_ops(lowering))
 
 class Intersection(ComposedObject):
     def __init__(self, children):
         ComposedObject.__init__(self, children)
     
-    def _openscad_operation(self):
-        return OpenscadOperation('intersection', [], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        return self._boolean_render_cost(child_costs)
+    
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('intersection', [], {}, self._openscad_child_ops(lowering))
     
-    def _openjscad_operation(self):
-        return OpenjsscadOperation('intersection', inputs=self._openjscad_child_ops())
+    def _openjscad_operation(self, lowering):
+        return OpenjsscadOperation('intersection', inputs=self._openjscad_child_ops(lowering))
 
 class Difference(ComposedObject):
     def __init__(self, children):
         ComposedObject.__init__(self, children)
     
-    def _openscad_operation(self):
-        return OpenscadOperation('difference', [], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        return self._boolean_render_cost(child_costs)
     
-    def _openjscad_operation(self):
-        return OpenjsscadOperation('difference', inputs=self._openjscad_child_ops())
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('difference', [], {}, self._openscad_child_ops(lowering))
+    
+    def _openjscad_operation(self, lowering):
+        return OpenjsscadOperation('difference', inputs=self._openjscad_child_ops(lowering))
 
 class Minkowski(ComposedObject):
     def __init__(self, children):
@@ -275,10 +329,20 @@ class Minkowski(ComposedObject):
     def get_child_transform_impl(self, index):
         raise ValueError('Transform matrix for Minkowski not defined yet.')
     
-    def _openscad_operation(self):
-        return OpenscadOperation('minkowski', [], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        if not child_costs:
+            return RenderCost(0, 0.0)
+        facets = child_costs[0].facets
+        cost = sum(child_cost.cost for child_cost in child_costs)
+        for child_cost in child_costs[1:]:
+            cost += facets * child_cost.facets
+            facets *= child_cost.facets
+        return RenderCost(facets, cost)
+    
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('minkowski', [], {}, self._openscad_child_ops(lowering))
     
-    def _openjscad_operation(self):
+    def _openjscad_operation(self, lowering):
         raise ValueError('OpenJSCAD does not support Minkowski.')
 
 class Hull(ComposedObject):
@@ -288,10 +352,15 @@ class Hull(ComposedObject):
     def get_child_transform_impl(self, index):
         raise ValueError('Transform matrix for Hull not defined yet.')
     
-    def _openscad_operation(self):
-        return OpenscadOperation('hull', [], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        facets = sum(child_cost.facets for child_cost in child_costs)
+        cost = sum(child_cost.cost for child_cost in child_costs)
+        return RenderCost(facets, cost + facets * math.log(facets + 1, 2))
     
-    def _openjscad_operation(self):
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('hull', [], {}, self._openscad_child_ops(lowering))
+    
+    def _openjscad_operation(self, lowering):
         raise ValueError('OpenJSCAD does not support Hull.')
 
 class Translate(ComposedObject):
@@ -305,11 +374,14 @@ class Translate(ComposedObject):
     def get_child_transform_impl(self, index):
         return Mat4.new_translate(self._offset)
     
-    def _openscad_operation(self):
-        return OpenscadOperation('translate', [self._offset], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        return self._transform_render_cost(child_costs)
+    
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('translate', [self._offset], {}, self._openscad_child_ops(lowering))
     
-    def _openjscad_operation(self):
-        return OpenjsscadOperation('translate', pos_args=[self._offset], inputs=self._openjscad_child_ops(), is_method=True)
+    def _openjscad_operation(self, lowering):
+        return OpenjsscadOperation('translate', pos_args=[self._offset], inputs=self._openjscad_child_ops(lowering), is_method=True)
 
 class Mirror(ComposedObject):
     def __init__(self, plane, children):
@@ -322,12 +394,15 @@ class Mirror(ComposedObject):
     def get_child_transform_impl(self, index):
         return Mat4.new_householder(self._plane)
     
-    def _openscad_operation(self):
-        return OpenscadOperation('mirror', [self._plane], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        return self._transform_render_cost(child_costs)
     
-    def _openjscad_operation(self):
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('mirror', [self._plane], {}, self._openscad_child_ops(lowering))
+    
+    def _openjscad_operation(self, lowering):
         matrix = Mat4.new_householder(self._plane)
-        return OpenjsscadOperation('transform', pos_args=[matrix], inputs=self._openjscad_child_ops(), is_method=True)
+        return OpenjsscadOperation('transform', pos_args=[matrix], inputs=self._openjscad_child_ops(lowering), is_method=True)
 
 class Transform(ComposedObject):
     def __init__(self, matrix, children):
@@ -340,11 +415,14 @@ class Transform(ComposedObject):
     def get_child_transform_impl(self, index):
         return self._matrix
     
-    def _openscad_operation(self):
-        return OpenscadOperation('multmatrix', [self._matrix], {}, self._openscad_child_ops())
+    def _render_cost(self, resolution, child_costs):
+        return self._transform_render_cost(child_costs)
+    
+    def _openscad_operation(self, lowering):
+        return OpenscadOperation('multmatrix', [self._matrix], {}, self._openscad_child_ops(lowering))
     
-    def _openjscad_operation(self):
-        return OpenjsscadOperation('transform', pos_args=[self._matrix], inputs=self._openjscad_child_ops(), is_method=True)
+    def _openjscad_operation(self, lowering):
+        return OpenjsscadOperation('transform', pos_args=[self._matrix], inputs=self._openjscad_child_ops(lowering), is_method=True)
 
 
 class OpenscadOperation(object):
@@ -376,8 +454,7 @@ class OpenjsscadOperation(object):
         self._inputs = inputs
         self._is_method = is_method
     
-    def build(self, indent):
-        istr = '    ' * indent
+    def build(self, bindings):
         args_str = ''
         if self._pos_args is not None:
             args_str = ', '.join(_val_to_openjscad(val) for val in self._pos_args)
@@ -385,30 +462,189 @@ class OpenjsscadOperation(object):
             kw_args_sorted = [(key, self._kw_args[key]) for key in sorted(self._kw_args)]
             args_str = '{{{}}}'.format(', '.join('{}: {}'.format(key, _val_to_openjscad(val)) for (key, val) in kw_args_sorted))
         if self._is_method:
-            return '{}.{}({})'.format(self._inputs[0].build(indent + 1), self._name, args_str)
+            return '{}.{}({})'.format(bindings.name_of(self._inputs[0]), self._name, args_str)
         else:
             if self._inputs is None:
                 return '{}({})'.format(self._name, args_str)
             else:
-                inputs_str = ', '.join(inp.build((indent + 1)) for inp in self._inputs)
+                inputs_str = ', '.join(bindings.name_of(inp) for inp in self._inputs)
                 if args_str != '':
                     return '{}({}, {})'.format(self._name, args_str, inputs_str)
                 else:
                     return '{}({})'.format(self._name, inputs_str)
 
+class _OpenjscadBindings(object):
+    def __init__(self):
+        self._op_names = {}
+        self._expr_names = {}
+        self._lines = []
+    
+    def name_of(self, op):
+        if id(op) not in self._op_names:
+            expr = op.build(self)
+            if expr not in self._expr_names:
+                name = 'v{}'.format(len(self._lines))
+                self._lines.append('var {} = {};'.format(name, expr))
+                self._expr_names[expr] = name
+            self._op_names[id(op)] = self._expr_names[expr]
+        return self._op_names[id(op)]
+    
+    def lines(self):
+        return self._lines
+
+
+class Resolution(object):
+    def __init__(self, tolerance, min_fn, max_fn):
+        tolerance = _float_arg(tolerance)
+        min_fn = _int_arg(min_fn)
+        max_fn = _int_arg(max_fn)
+        
+        assert tolerance > 0.0, "Tolerance must be positive."
+        assert 3 <= min_fn <= max_fn, "Invalid fn limits."
+        
+        self._tolerance = tolerance
+        self._min_fn = min_fn
+        self._max_fn = max_fn
+    
+    def fn_for_radius(self, r):
+        # Smallest segment count whose chords deviate from the circle by at most the tolerance.
+        if r <= self._tolerance:
+            return self._min_fn
+        fn = int(math.ceil(math.pi / math.acos(1.0 - self._tolerance / r)))
+        # Round up to a multiple of 4 so that the faceting is symmetric about the axes.
+        fn = (fn + 3) // 4 * 4
+        return max(self._min_fn, min(self._max_fn, fn))
+
+
+class RenderCost(object):
+    def __init__(self, facets, cost):
+        self.facets = facets
+        self.cost = cost
+
+class CostEstimate(object):
+    def __init__(self, name, path, obj, facets, cost, own_cost):
+        self.name = name
+        self.path = path
+        self.obj = obj
+        self.facets = facets
+        self.cost = cost
+        self.own_cost = own_cost
+        self.occurrences = 0
+    
+    def path_str(self):
+        return self.name + ''.join('.child({})'.format(index) for index in self.path)
+
+def estimate_cost(obj, quality='default', name='model'):
+    resolution = _resolution_arg(quality)
+    memo = {}
+    estimates = {}
+    order = []
+    
+    def visit(obj, path):
+        if id(obj) in estimates:
+            return
+        render_cost = _render_cost(obj, resolution, memo)
+        children = obj._children if isinstance(obj, ComposedObject) else []
+        own_cost = render_cost.cost - sum(memo[id(child)].cost for child in children)
+        estimates[id(obj)] = CostEstimate(name, path, obj, render_cost.facets, render_cost.cost, own_cost)
+        for (index, child) in enumerate(children):
+            visit(child, path + (index,))
+        order.append(estimates[id(obj)])
+    
+    visit(obj, ())
+    
+    # Parents come before their children in reverse post-order, so occurrence
+    # counts can be pushed down in a single pass.
+    order.reverse()
+    order[0].occurrences = 1
+    for est in order:
+        if isinstance(est.obj, ComposedObject):
+            for child in est.obj._children:
+                estimates[id(child)].occurrences += est.occurrences
+    
+    return sorted(order, key=lambda est: est.path)
+
+def format_cost_report(estimates, top=10):
+    ranked = heapq.nlargest(top, estimates, key=lambda est: (est.own_cost * est.occurrences, est.cost))
+    lines = ['{:>14} {:>14} {:>10} {:>8}  {}'.format('cost', 'own cost', 'facets', 'count', 'subtree')]
+    for est in ranked:
+        lines.append('{:>14.0f} {:>14.0f} {:>10} {:>8}  {} ({})'.format(est.cost, est.own_cost, est.facets, est.occurrences, est.path_str(), type(est.obj).__name__))
+    return ''.join('{}\n'.format(line) for line in lines)
+
+FORMAT_EXTENSIONS = {
+    'openscad': 'scad',
+    'openjscad': 'jscad',
+}
+
+class _Lowering(object):
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self._openscad_ops = {}
+        self._openjscad_ops = {}
+    
+    def openscad_operation(self, obj):
+        if id(obj) not in self._openscad_ops:
+            self._openscad_ops[id(obj)] = obj._openscad_operation(self)
+        return self._openscad_ops[id(obj)]
+    
+    def openjscad_operation(self, obj):
+        if id(obj) not in self._openjscad_ops:
+            self._openjscad_ops[id(obj)] = obj._openjscad_operation(self)
+        return self._openjscad_ops[id(obj)]
+    
+    def build(self, obj, fmt):
+        if fmt == 'openscad':
+            all_imports = []
+            body = self.openscad_operation(obj).build(0, all_imports)
+            import_str = ''.join('use <{}>;\n'.format(imp) for imp in all_imports)
+            res = import_str + '\n' + body
+        elif fmt == 'openjscad':
+            bindings = _OpenjscadBindings()
+            result = bindings.name_of(self.openjscad_operation(obj))
+            body = ''.join('    {}\n'.format(line) for line in bindings.lines())
+            res = 'function main() {{\n{}    return {};\n}}'.format(body, result)
+        else:
+            raise ValueError('Unknown output format: {}.'.format(fmt))
+        return res
+
+def build_output(obj, fmt, quality='default', cost_budget=None):
+    resolution = _resolution_arg(quality)
+    _check_cost_budget(obj, 'model', resolution, cost_budget)
+    return _Lowering(resolution).build(obj, fmt)
+
+def build_outputs(parts, formats, quality='default', cost_budget=None):
+    resolution = _resolution_arg(quality)
+    for fmt in formats:
+        if fmt not in FORMAT_EXTENSIONS:
+            raise ValueError('Unknown output format: {}.'.format(fmt))
+    for name in sorted(parts):
+        if not isinstance(name, basestring) or name in ('', '.', '..') or os.path.basename(name) != name:
+            raise ValueError('Invalid part name: {!r}. Part names must be plain file names.'.format(name))
+        _check_cost_budget(parts[name], name, resolution, cost_budget)
+    lowering = _Lowering(resolution)
+    return dict(((name, fmt), lowering.build(parts[name], fmt)) for name in sorted(parts) for fmt in formats)
+
+
+def _check_cost_budget(obj, name, resolution, cost_budget):
+    if cost_budget is None:
+        return
+    total_cost = _render_cost(obj, resolution, {}).cost
+    if total_cost > cost_budget:
+        raise ValueError('Estimated render cost {:.0f} of {} exceeds budget {:.0f}.'.format(total_cost, name, cost_budget))
+
+def _render_cost(obj, resolution, memo):
+    if id(obj) not in memo:
+        if isinstance(obj, ComposedObject):
+            child_costs = [_render_cost(child, resolution, memo) for child in obj._children]
+        else:
+            child_costs = []
+        memo[id(obj)] = obj._render_cost(resolution, child_costs)
+    return memo[id(obj)]
 
-def build_output(obj, fmt):
-    if fmt == 'openscad':
-        all_imports = []
-        body = obj._openscad_operation().build(0, all_imports)
-        import_str = ''.join('use <{}>;\n'.format(imp) for imp in all_imports)
-        res = import_str + '\n' + body
-    elif fmt == 'openjscad':
-        res = 'function main() {{\n    return (\n{}\n    );\n}}'.format(obj._openjscad_operation().build(2))
-    else:
-        raise ValueError('Unknown output format: {}.'.format(fmt))
-    return res
+_UNKNOWN_FACET_COUNT = 100
 
+def _resolve_fn(fn, r, resolution):
+    return fn if fn is not None else resolution.fn_for_radius(r)
 
 def _val_to_openscad(val):
     if isinstance(val, Vec3):
@@ -444,6 +680,13 @@ def _val_to_openjscad(val):
 def _number_to_openjscad(val):
     return '{:.9E}'.format(val)
 
+def _resolution_arg(x):
+    if isinstance(x, Resolution):
+        return x
+    if x not in QUALITIES:
+        raise ValueError('Unknown quality: {}.'.format(x))
+    return QUALITIES[x]
+
 def _bool_arg(x):
     assert type(x) is bool, "Argument must be a bool."
     return x
@@ -479,3 +722,13 @@ def _mat4_arg(x, allow_none=False):
     assert type(x) is Mat4, "Argument must be a Mat4."
     return x
 
+
+Resolution.DEFAULT = Resolution(0.01, 32, 32)
+Resolution.FINAL = Resolution(0.01, 12, 256)
+Resolution.PREVIEW = Resolution(0.1, 8, 48)
+
+QUALITIES = {
+    'default': Resolution.DEFAULT,
+    'final': Resolution.FINAL,
+    'preview': Resolution.PREVIEW,
+}
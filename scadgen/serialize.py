@@ -0,0 +1,243 @@
+import sys
+import array
+import struct
+from itertools import izip
+from scad import *
+from spacemath import *
+
+# Layout: header, structure ints, floats, string lengths, string bytes.
+# Nodes are stored children first and referenced by index, so shared
+# subtrees are stored once. Each node names a shape (class name plus
+# attribute names) which is stored once per distinct shape and must match
+# the class's entry in _NODE_SCHEMAS. All sections are little-endian.
+
+_MAGIC = 'SCADGEN\x00'
+_VERSION = 1
+_HEADER = struct.Struct('<8sIIIIIII')
+
+(_TAG_NONE, _TAG_FALSE, _TAG_TRUE, _TAG_INT, _TAG_BIGINT, _TAG_LONG, _TAG_FLOAT, _TAG_STR, _TAG_UNICODE,
+ _TAG_VEC3, _TAG_MAT4, _TAG_TUPLE, _TAG_LIST, _TAG_DICT, _TAG_NODE) = range(15)
+
+_NODE_SCHEMAS = dict((cls.__name__, (cls, tuple(sorted(names)))) for (cls, names) in (
+    (Cube, ('_size', '_centered', '_offset', '_has_offset')),
+    (Cylinder, ('_h', '_r1', '_r2', '_center', '_fn', '_internal', '_flat_base')),
+    (Sphere, ('_r', '_fn')),
+    (OpenscadModule, ('_mod_name', '_args', '_kwargs', '_imports')),
+    (Import, ('_src_file',)),
+    (Union, ('_children',)),
+    (Intersection, ('_children',)),
+    (Difference, ('_children',)),
+    (Minkowski, ('_children',)),
+    (Hull, ('_children',)),
+    (Translate, ('_children', '_offset')),
+    (Mirror, ('_children', '_plane')),
+    (Transform, ('_children', '_matrix')),
+))
+
+_INT_MIN = -2**31
+_INT_MAX = 2**31 - 1
+
+
+def dump_model(model):
+    encoder = _Encoder()
+    return encoder.dump(model)
+
+def load_model(data):
+    if len(data) < _HEADER.size:
+        raise ValueError('Not a serialized scadgen model.')
+    (magic, version, num_shapes, num_nodes, num_ints, num_floats, num_strings, blob_size) = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError('Not a serialized scadgen model.')
+    if version != _VERSION:
+        raise ValueError('Unsupported model format version: {}.'.format(version))
+    
+    pos = _HEADER.size
+    (ints, pos) = _read_array('i', data, pos, num_ints)
+    (floats, pos) = _read_array('d', data, pos, num_floats)
+    (lengths, pos) = _read_array('i', data, pos, num_strings)
+    if len(data) != pos + blob_size:
+        raise ValueError('Truncated or corrupt serialized model.')
+    
+    strings = []
+    for length in lengths:
+        strings.append(data[pos:pos+length])
+        pos += length
+    
+    return _decode(ints, floats, strings, num_shapes, num_nodes)
+
+
+class _Encoder(object):
+    def __init__(self):
+        self._ints = array.array('i')
+        self._floats = array.array('d')
+        self._strings = []
+        self._string_ids = {}
+        self._shapes = array.array('i')
+        self._shape_ids = {}
+        self._node_ids = {}
+    
+    def dump(self, model):
+        ints = array.array('i')
+        floats = array.array('d')
+        self.value(model, ints, floats)
+        self._ints.extend(ints)
+        self._floats.extend(floats)
+        
+        lengths = array.array('i', (len(s) for s in self._strings))
+        blob = ''.join(self._strings)
+        header = _HEADER.pack(_MAGIC, _VERSION, len(self._shape_ids), len(self._node_ids), len(self._shapes) + len(self._ints), len(self._floats), len(self._strings), len(blob))
+        return ''.join((header, _array_to_string(self._shapes), _array_to_string(self._ints), _array_to_string(self._floats), _array_to_string(lengths), blob))
+    
+    def string(self, s):
+        if s not in self._string_ids:
+            self._string_ids[s] = len(self._strings)
+            self._strings.append(s)
+        return self._string_ids[s]
+    
+    def shape(self, class_name, names):
+        key = (class_name, names)
+        if key not in self._shape_ids:
+            self._shape_ids[key] = len(self._shape_ids)
+            self._shapes.append(self.string(class_name))
+            self._shapes.append(len(names))
+            self._shapes.extend(self.string(name) for name in names)
+        return self._shape_ids[key]
+    
+    def node(self, obj):
+        if id(obj) not in self._node_ids:
+            class_name = type(obj).__name__
+            if class_name not in _NODE_SCHEMAS or _NODE_SCHEMAS[class_name][0] is not type(obj):
+                raise TypeError('Cannot serialize object of type {}.'.format(class_name))
+            
+            ints = array.array('i')
+            floats = array.array('d')
+            state = obj.__dict__
+            names = tuple(sorted(state))
+            if names != _NODE_SCHEMAS[class_name][1]:
+                raise TypeError('Attributes of {} object do not match its serialization schema: {}.'.format(class_name, ', '.join(names)))
+            ints.append(self.shape(class_name, names))
+            for name in names:
+                self.value(state[name], ints, floats)
+            
+            self._ints.extend(ints)
+            self._floats.extend(floats)
+            self._node_ids[id(obj)] = len(self._node_ids)
+        return self._node_ids[id(obj)]
+    
+    def value(self, val, ints, floats):
+        if val is None:
+            ints.append(_TAG_NONE)
+        elif type(val) is bool:
+            ints.append(_TAG_TRUE if val else _TAG_FALSE)
+        elif type(val) is int:
+            if _INT_MIN <= val <= _INT_MAX:
+                ints.extend((_TAG_INT, val))
+            else:
+                ints.extend((_TAG_BIGINT, self.string(str(val))))
+        elif type(val) is long:
+            ints.extend((_TAG_LONG, self.string(str(val))))
+        elif type(val) is float:
+            ints.append(_TAG_FLOAT)
+            floats.append(val)
+        elif type(val) is str:
+            ints.extend((_TAG_STR, self.string(val)))
+        elif type(val) is unicode:
+            ints.extend((_TAG_UNICODE, self.string(val.encode('utf-8'))))
+        elif type(val) is Vec3:
+            ints.append(_TAG_VEC3)
+            floats.extend(val[i] for i in range(3))
+        elif type(val) is Mat4:
+            ints.append(_TAG_MAT4)
+            floats.extend(val.at(i, j) for i in range(4) for j in range(4))
+        elif type(val) is tuple or type(val) is list:
+            ints.extend((_TAG_TUPLE if type(val) is tuple else _TAG_LIST, len(val)))
+            for elem in val:
+                self.value(elem, ints, floats)
+        elif type(val) is dict:
+            ints.extend((_TAG_DICT, len(val)))
+            for key in sorted(val):
+                self.value(key, ints, floats)
+                self.value(val[key], ints, floats)
+        elif isinstance(val, Object):
+            ints.extend((_TAG_NODE, self.node(val)))
+        else:
+            raise TypeError('Cannot serialize value of type {}.'.format(type(val).__name__))
+
+def _decode(ints, floats, strings, num_shapes, num_nodes):
+    next_int = iter(ints).next
+    next_float = iter(floats).next
+    nodes = []
+    
+    def value():
+        return readers[next_int()]()
+    
+    def dict_value():
+        items = []
+        for _ in xrange(next_int()):
+            key = value()
+            items.append((key, value()))
+        return dict(items)
+    
+    readers = {
+        _TAG_NONE: lambda: None,
+        _TAG_FALSE: lambda: False,
+        _TAG_TRUE: lambda: True,
+        _TAG_INT: next_int,
+        _TAG_BIGINT: lambda: int(strings[next_int()]),
+        _TAG_LONG: lambda: long(strings[next_int()]),
+        _TAG_FLOAT: next_float,
+        _TAG_STR: lambda: strings[next_int()],
+        _TAG_UNICODE: lambda: strings[next_int()].decode('utf-8'),
+        _TAG_VEC3: lambda: Vec3(v=[next_float(), next_float(), next_float()]),
+        _TAG_MAT4: lambda: Mat4(m=[[next_float(), next_float(), next_float(), next_float()] for _ in xrange(4)]),
+        _TAG_TUPLE: lambda: tuple([value() for _ in xrange(next_int())]),
+        _TAG_LIST: lambda: [value() for _ in xrange(next_int())],
+        _TAG_DICT: dict_value,
+        _TAG_NODE: lambda: nodes[next_int()],
+    }
+    
+    try:
+        shapes = []
+        for _ in xrange(num_shapes):
+            class_name = strings[next_int()]
+            if class_name not in _NODE_SCHEMAS:
+                raise ValueError('Unknown object type in serialized model: {}.'.format(class_name))
+            names = tuple([strings[next_int()] for _ in xrange(next_int())])
+            (cls, expected_names) = _NODE_SCHEMAS[class_name]
+            if names != expected_names:
+                raise ValueError('Serialized {} has attributes ({}) but this version of scadgen expects ({}).'.format(class_name, ', '.join(names), ', '.join(expected_names)))
+            shapes.append((cls, names))
+        for _ in xrange(num_nodes):
+            (cls, names) = shapes[next_int()]
+            obj = cls.__new__(cls)
+            obj.__dict__.update(izip(names, [value() for _ in names]))
+            nodes.append(obj)
+        model = value()
+    except (KeyError, IndexError, StopIteration):
+        raise ValueError('Truncated or corrupt serialized model.')
+    
+    for remaining in (next_int, next_float):
+        try:
+            remaining()
+        except StopIteration:
+            continue
+        raise ValueError('Truncated or corrupt serialized model.')
+    
+    return model
+
+
+def _array_to_string(arr):
+    if sys.byteorder == 'big':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+def _read_array(typecode, data, pos, count):
+    arr = array.array(typecode)
+    end = pos + count * arr.itemsize
+    if len(data) < end:
+        raise ValueError('Truncated or corrupt serialized model.')
+    arr.fromstring(data[pos:end])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return (arr, end)